@@ -13,6 +13,8 @@ from functools import wraps
 from shutil import rmtree
 from tempfile import mkdtemp, mkstemp
 
+import dask
+import numpy as np
 import pandas as pd
 import xarray as xr
 from dask import compute, delayed
@@ -25,26 +27,41 @@ logger = logging.getLogger(__name__)
 from atlite.datasets import modules as datamodules
 
 
-def get_features(cutout, module, features, tmpdir=None):
+def get_features(
+    cutout, module, features, tmpdir=None, lock=None, concurrent_requests=1
+):
     """
     Load the feature data for a given module.
 
     This get the data for a set of features from a module. All modules
-    in `atlite.datasets` are allowed.
+    in `atlite.datasets` are allowed. The data is returned as a delayed
+    object, such that the features of several modules can be retrieved
+    concurrently in a single call to `dask.compute`.
     """
     parameters = cutout.data.attrs
-    lock = SerializableLock()
+    if lock is None:
+        lock = SerializableLock()
     datasets = []
     get_data = datamodules[module].get_data
 
     for feature in features:
         feature_data = delayed(get_data)(
-            cutout, feature, tmpdir=tmpdir, lock=lock, **parameters
+            cutout,
+            feature,
+            tmpdir=tmpdir,
+            lock=lock,
+            concurrent_requests=concurrent_requests,
+            **parameters,
         )
         datasets.append(feature_data)
 
-    datasets = compute(*datasets)
+    return delayed(merge_features)(datasets, module)
 
+
+def merge_features(datasets, module):
+    """
+    Merge the feature datasets of a module and label their variables.
+    """
     ds = xr.merge(datasets, compat="equals")
     for v in ds:
         ds[v].attrs["module"] = module
@@ -90,6 +107,26 @@ def non_bool_dict(d):
     return {k: v if not isinstance(v, bool) else int(v) for k, v in d.items()}
 
 
+def chunksizes(da, chunks, dtype=None, max_bytes=2**28):
+    """
+    Get the netCDF chunk sizes of a variable aligned with the cutout chunks.
+
+    Dimensions which are not chunked in the cutout are stored in one piece,
+    such that reading one cutout chunk touches exactly one chunk on disk.
+    Chunks larger than `max_bytes` (for the on-disk `dtype`) are split by
+    halving their largest dimension, as HDF5 does not support chunks of
+    4 GiB or more.
+    """
+    chunks = {k: v for k, v in (chunks or {}).items() if pd.api.types.is_integer(v)}
+    chunks = {k: v for k, v in chunks.items() if v > 0}
+    sizes = [int(min(chunks.get(d, n), n)) for d, n in da.sizes.items()]
+    itemsize = np.dtype(dtype or da.dtype).itemsize
+    while np.prod(sizes, dtype=float) * itemsize > max_bytes and max(sizes) > 1:
+        i = int(np.argmax(sizes))
+        sizes[i] = -(-sizes[i] // 2)
+    return tuple(sizes)
+
+
 def maybe_remove_tmpdir(func):
     "Use this wrapper to make tempfile deletion compatible with windows machines."
 
@@ -115,6 +152,9 @@ def cutout_prepare(
     tmpdir=None,
     overwrite=False,
     compression={"zlib": True, "complevel": 9, "shuffle": True},
+    dask_kwargs=None,
+    concurrent_requests=1,
+    write_once=False,
 ):
     """
     Prepare all or a selection of features in a cutout.
@@ -147,6 +187,31 @@ def cutout_prepare(
         To efficiently reduce cutout sizes, specify the number of 'least_significant_digits': n here.
         To disable compression, set "complevel" to None.
         Default is {'zlib': True, 'complevel': 9, 'shuffle': True}.
+        Independent of the compression, float64 variables are stored as
+        float32.
+    dask_kwargs : dict, optional
+        Keyword arguments passed to `dask.compute()` when retrieving the
+        features and writing the cutout, e.g.
+        `{"scheduler": "processes", "num_workers": 4}`. A given scheduler is
+        also activated via `dask.config.set` during the preparation, such that
+        xarray chooses the file locks for writing the cutout accordingly. As
+        xarray cannot write netcdf files from worker processes, the cutout is
+        written with threads if a process-based scheduler is given. The
+        default uses the globally configured dask scheduler.
+    concurrent_requests : int, optional
+        Maximum number of monthly data requests which are posted at the same
+        time for each feature (only relevant for the ERA5 module). As the
+        features are retrieved in parallel, up to `concurrent_requests` times
+        the number of features requests may be queued at the CDS. The
+        requests of a feature always run in a local thread pool, independent
+        of the scheduler given in `dask_kwargs`. The default is 1, i.e. the
+        months are requested one after another.
+    write_once : bool, optional
+        Whether to retrieve the features of all modules concurrently and write
+        the cutout file once at the end. This avoids rewriting the cutout per
+        module, but a failure in any module or in the final write discards
+        the features of all modules, including completed downloads. The
+        default is False, writing the cutout after each module.
 
     Returns
     -------
@@ -159,6 +224,17 @@ def cutout_prepare(
 
     logger.info(f"Storing temporary files in {tmpdir}")
 
+    if dask_kwargs is None:
+        dask_kwargs = {}
+    # xarray picks the locks for writing netcdf files based on the active
+    # scheduler, not on the one passed to compute. Its locks cannot be shared
+    # with worker processes, so these fall back to threads for writing
+    scheduler = {k: v for k, v in dask_kwargs.items() if k == "scheduler"}
+    write_scheduler = scheduler
+    if scheduler.get("scheduler") in ["processes", "multiprocessing"]:
+        write_scheduler = {"scheduler": "threads"}
+    write_kwargs = {**dask_kwargs, **write_scheduler}
+
     modules = atleast_1d(cutout.module)
     features = atleast_1d(features) if features else slice(None)
     prepared = set(atleast_1d(cutout.data.attrs["prepared_features"]))
@@ -166,27 +242,84 @@ def cutout_prepare(
     # target is series of all available variables for given module and features
     target = available_features(modules).loc[:, features].drop_duplicates()
 
+    # collect the delayed retrieval of the missing variables of all modules
+    lock = SerializableLock()
+    missing = {}
     for module in target.index.unique("module"):
         missing_vars = target[module]
         if not overwrite:
             missing_vars = missing_vars[lambda v: ~v.isin(cutout.data)]
         if missing_vars.empty:
             continue
-        logger.info(f"Calculating and writing with module {module}:")
+        logger.info(f"Requesting features of module {module}")
         missing_features = missing_vars.index.unique("feature")
-        ds = get_features(cutout, module, missing_features, tmpdir=tmpdir)
-        prepared |= set(missing_features)
+        module_ds = get_features(
+            cutout,
+            module,
+            missing_features,
+            tmpdir=tmpdir,
+            lock=lock,
+            concurrent_requests=concurrent_requests,
+        )
+        missing[module] = (missing_vars, module_ds)
 
-        cutout.data.attrs.update(dict(prepared_features=list(prepared)))
-        attrs = non_bool_dict(cutout.data.attrs)
-        attrs.update(ds.attrs)
+    if not missing:
+        return cutout
 
-        # Add optional compression to the newly prepared features
-        if compression:
+    # by default write the cutout after each module, such that the features of
+    # completed modules are kept if a later module fails
+    if write_once:
+        groups = [list(missing)]
+    else:
+        groups = [[module] for module in missing]
+
+    for group in groups:
+        with dask.config.set(scheduler):
+            module_datasets = compute(*(missing[m][1] for m in group), **dask_kwargs)
+
+        ds = cutout.data
+        attrs = {}
+        for module, module_ds in zip(group, module_datasets):
+            missing_vars = missing[module][0]
+            attrs.update(module_ds.attrs)
+
+            # Add optional compression to the newly prepared features and align
+            # the chunks on disk with the chunks used when reading the cutout
             for v in missing_vars:
-                ds[v].encoding.update(compression)
+                encoding = module_ds[v].encoding
+                if compression:
+                    encoding.update(compression)
+                # weather data does not need double precision, store it as
+                # float32 unless it is packed by the source's own encoding.
+                # NaNs of variables stored as floats are stored as they are,
+                # so no fill value is needed, which spares the masking step
+                # when reading
+                if "scale_factor" not in encoding:
+                    if module_ds[v].dtype == "float64":
+                        encoding["dtype"] = "float32"
+                    dtype = np.dtype(encoding.get("dtype", module_ds[v].dtype))
+                    if dtype.kind == "f":
+                        encoding["_FillValue"] = None
+                if module_ds[v].ndim:
+                    # drop the layout of the source files, xarray ignores the
+                    # chunksizes if the original shape does not match anymore
+                    for key in [
+                        "contiguous",
+                        "original_shape",
+                        "preferred_chunks",
+                        "source",
+                    ]:
+                        encoding.pop(key, None)
+                    encoding["chunksizes"] = chunksizes(
+                        module_ds[v], cutout.chunks, dtype=encoding.get("dtype")
+                    )
+
+            ds = ds.merge(module_ds[missing_vars.values])
+            prepared |= set(missing_vars.index.unique("feature"))
 
-        ds = cutout.data.merge(ds[missing_vars.values]).assign_attrs(**attrs)
+        cutout.data.attrs.update(dict(prepared_features=list(prepared)))
+        attrs = {**non_bool_dict(cutout.data.attrs), **attrs}
+        ds = ds.assign_attrs(**attrs)
 
         # write data to tmp file, copy it to original data, this is much safer
         # than appending variables
@@ -197,14 +330,20 @@ def cutout_prepare(
         logger.debug("Writing cutout to file...")
         # Delayed writing for large cutout
         # cf. https://stackoverflow.com/questions/69810367/python-how-to-write-large-netcdf-with-xarray
-        write_job = ds.to_netcdf(tmp, compute=False)
-        with ProgressBar():
-            write_job.compute()
-        if cutout.path.exists():
-            cutout.data.close()
-            cutout.path.unlink()
-        os.rename(tmp, cutout.path)
-
-        cutout.data = xr.open_dataset(cutout.path, chunks=cutout.chunks)
+        try:
+            with dask.config.set(write_scheduler):
+                write_job = ds.to_netcdf(tmp, compute=False)
+                with ProgressBar():
+                    write_job.compute(**write_kwargs)
+        except BaseException:
+            # do not leave a partially written file next to the cutout
+            os.unlink(tmp)
+            raise
+        # replace the cutout atomically, such that the file is never missing
+        cutout.data.close()
+        os.replace(tmp, cutout.path)
+
+        # keep the cutout data dask-backed, also if no explicit chunks are set
+        cutout.data = xr.open_dataset(cutout.path, chunks=cutout.chunks or "auto")
 
     return cutout
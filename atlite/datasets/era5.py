@@ -20,6 +20,7 @@ import cdsapi
 import numpy as np
 import pandas as pd
 import xarray as xr
+from dask import compute, delayed
 from numpy import atleast_1d
 
 from atlite.gis import maybe_swap_spatial_dims
@@ -344,7 +345,10 @@ def retrieve_data(product, chunks=None, tmpdir=None, lock=None, **updates):
         logger.info(f"CDS: Downloading variables\n\t{varstr}\n")
         result.download(target)
 
-    ds = xr.open_dataset(target, chunks=chunks or {})
+    # open lazily with dask, such that the downloaded file is only read chunk
+    # by chunk when writing the cutout. Without cutout chunks, let dask pick
+    # moderate chunk sizes instead of reading each variable in one piece.
+    ds = xr.open_dataset(target, chunks=chunks or "auto")
     if tmpdir is None:
         logger.debug(f"Adding finalizer for {target}")
         weakref.finalize(ds._file_obj._manager, noisy_unlink, target)
@@ -361,7 +365,9 @@ def retrieve_data(product, chunks=None, tmpdir=None, lock=None, **updates):
     return ds
 
 
-def get_data(cutout, feature, tmpdir, lock=None, **creation_parameters):
+def get_data(
+    cutout, feature, tmpdir, lock=None, concurrent_requests=1, **creation_parameters
+):
     """
     Retrieve data from ECMWFs ERA5 dataset (via CDS).
 
@@ -376,6 +382,12 @@ def get_data(cutout, feature, tmpdir, lock=None, **creation_parameters):
         `atlite.datasets.era5.features`
     tmpdir : str/Path
         Directory where the temporary netcdf files are stored.
+    concurrent_requests : int, optional
+        Maximum number of monthly data requests which are posted at the same
+        time. The requests run in a local thread pool of this size, independent
+        of the dask scheduler used for the preparation. The downloads themselves
+        are still serialized by `lock`. The default is 1, i.e. the requests are
+        posted one after another.
     **creation_parameters :
         Additional keyword arguments. The only effective argument is 'sanitize'
         (default True) which sets sanitization of the data on or off.
@@ -412,6 +424,14 @@ def get_data(cutout, feature, tmpdir, lock=None, **creation_parameters):
     if feature in static_features:
         return retrieve_once(retrieval_times(coords, static=True)).squeeze()
 
-    datasets = map(retrieve_once, retrieval_times(coords))
+    if concurrent_requests and concurrent_requests > 1:
+        delayed_datasets = [
+            delayed(retrieve_once)(time) for time in retrieval_times(coords)
+        ]
+        datasets = compute(
+            *delayed_datasets, scheduler="threads", num_workers=concurrent_requests
+        )
+    else:
+        datasets = map(retrieve_once, retrieval_times(coords))
 
     return xr.concat(datasets, dim="time").sel(time=coords["time"])
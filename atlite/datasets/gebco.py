@@ -10,10 +10,11 @@ Module for loading gebco data.
 
 import logging
 
+import numpy as np
 import rasterio as rio
 import xarray as xr
 from pandas import to_numeric
-from rasterio.warp import Resampling
+from rasterio.warp import Resampling, reproject
 
 logger = logging.getLogger(__name__)
 
@@ -22,18 +23,22 @@ features = {"height": ["height"]}
 
 
 def get_data_gebco_height(xs, ys, gebco_path):
-    x, X = xs.data[[0, -1]]
-    y, Y = ys.data[[0, -1]]
+    corners = np.stack([xs.data[[0, -1]], ys.data[[0, -1]]], axis=1)
+    minc, maxc = corners.min(0), corners.max(0)
+    dx, dy = (maxc - minc) / (np.array([len(xs), len(ys)]) - 1)
 
-    dx = (X - x) / (len(xs) - 1)
-    dy = (Y - y) / (len(ys) - 1)
+    # warp the gebco data in-process directly onto the (north-up) cutout grid
+    transform = rio.transform.from_origin(minc[0] - dx / 2, maxc[1] + dy / 2, dx, dy)
+    gebco = np.full((len(ys), len(xs)), np.nan, dtype="float32")
 
     with rio.open(gebco_path) as dataset:
-        window = dataset.window(x - dx / 2, y - dy / 2, X + dx / 2, Y + dy / 2)
-        gebco = dataset.read(
-            indexes=1,
-            window=window,
-            out_shape=(len(ys), len(xs)),
+        reproject(
+            source=rio.band(dataset, 1),
+            destination=gebco,
+            src_crs=dataset.crs or crs,
+            dst_transform=transform,
+            dst_crs=crs,
+            dst_nodata=np.nan,
             resampling=Resampling.average,
         )
         gebco = gebco[::-1]  # change inversed y-axis
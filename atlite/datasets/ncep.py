@@ -16,9 +16,6 @@ for the time being!
 
 import glob
 import os
-import shutil
-import subprocess
-import tempfile
 
 import numpy as np
 import pandas as pd
@@ -198,7 +198,15 @@ def get_data(cutout, feature, tmpdir, lock=None, **creation_parameters):
     creation_parameters.setdefault("sarah_interpolate", True)
 
     files = get_filenames(sarah_dir, coords)
-    open_kwargs = dict(chunks=chunks, parallel=creation_parameters["parallel"])
+    # the files only differ in time, skip comparing the other variables and
+    # coordinates of all files against each other
+    open_kwargs = dict(
+        chunks=chunks,
+        parallel=creation_parameters["parallel"],
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+    )
     ds_sis = xr.open_mfdataset(files.sis, combine="by_coords", **open_kwargs)
     ds_sid = xr.open_mfdataset(files.sid, combine="by_coords", **open_kwargs)
     ds = xr.merge([ds_sis, ds_sid])
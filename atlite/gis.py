@@ -9,7 +9,10 @@ Functions for Geographic Information System.
 
 import logging
 import multiprocessing as mp
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from functools import wraps
 from pathlib import Path
 from warnings import catch_warnings, simplefilter, warn
@@ -674,7 +677,12 @@ def _process_func(i):
 
 
 def compute_availabilitymatrix(
-    cutout, shapes, excluder, nprocesses=None, disable_progressbar=False
+    cutout,
+    shapes,
+    excluder,
+    nprocesses=None,
+    disable_progressbar=False,
+    use_threads=False,
 ):
     """
     Compute the eligible share within cutout cells in the overlap with shapes.
@@ -699,6 +707,13 @@ def compute_availabilitymatrix(
         Disable the progressbar if nprocesses is not None. Then the `map`
         function instead of the `imap` function is used for the multiprocessing
         pool. This speeds up the calculation.
+    use_threads : bool, optional
+        Run the parallel calculation (nprocesses not None) with `nprocesses`
+        threads instead of processes. Each thread opens its own copy of the
+        excluder files. This avoids spawning processes and pickling the
+        shapes and the excluder, but only pays off if most of the time is
+        spent in reading and reprojecting rasters, during which GDAL releases
+        the GIL. The default is False.
 
     Returns
     -------
@@ -737,19 +752,56 @@ def compute_availabilitymatrix(
         assert (
             excluder.all_closed
         ), "For parallelization all raster files in excluder must be closed"
-        kwargs = {
-            "initializer": _init_process,
-            "initargs": (shapes, *args),
-            "maxtasksperchild": 20,
-            "processes": nprocesses,
-        }
-        with mp.get_context("spawn").Pool(**kwargs) as pool:
-            if disable_progressbar:
-                availability = list(pool.map(_process_func, shapes.index))
-            else:
-                availability = list(
-                    tqdm(pool.imap(_process_func, shapes.index), **tqdm_kwargs)
-                )
+        if use_threads:
+            local = threading.local()
+            excluders = []
+
+            def _thread_func(i):
+                # rasterio datasets must not be shared between threads
+                if not hasattr(local, "args"):
+                    local.args = (deepcopy(excluder), *args[1:])
+                    excluders.append(local.args[0])
+                return shape_availability_reprojected(shapes.loc[[i]], *local.args)[0]
+
+            # warning filters are process-wide, set them outside of the threads
+            try:
+                with catch_warnings(), ThreadPoolExecutor(nprocesses) as executor:
+                    simplefilter("ignore")
+                    if disable_progressbar:
+                        availability = list(executor.map(_thread_func, shapes.index))
+                    else:
+                        availability = list(
+                            tqdm(
+                                executor.map(_thread_func, shapes.index), **tqdm_kwargs
+                            )
+                        )
+            finally:
+                # the copies opened their own rasters, close them with the pool
+                for e in excluders:
+                    for d in e.rasters:
+                        if isinstance(d["raster"], rio.DatasetReader):
+                            d["raster"].close()
+        else:
+            kwargs = {
+                "initializer": _init_process,
+                "initargs": (shapes, *args),
+                "maxtasksperchild": 20,
+                "processes": nprocesses,
+            }
+            # send the shapes in batches to amortize the inter-process overhead
+            chunksize = max(1, len(shapes) // (4 * nprocesses))
+            with mp.get_context("spawn").Pool(**kwargs) as pool:
+                if disable_progressbar:
+                    availability = list(
+                        pool.map(_process_func, shapes.index, chunksize=chunksize)
+                    )
+                else:
+                    availability = list(
+                        tqdm(
+                            pool.imap(_process_func, shapes.index, chunksize=chunksize),
+                            **tqdm_kwargs,
+                        )
+                    )
 
     availability = np.stack(availability)[:, ::-1]  # flip axis, see Notes
     coords = [(shapes.index), ("y", cutout.data.y.data), ("x", cutout.data.x.data)]
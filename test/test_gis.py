@@ -603,6 +603,39 @@ def test_availability_matrix_rastered(ref, raster):
     assert_equal(ds, ref.availabilitymatrix(shapes, excluder, 2))
 
 
+def test_availability_matrix_rastered_threads(ref, raster, monkeypatch):
+    """
+    Availability matrix computed with threads must be the same as the serial
+    one, and the rasters opened by the threads must be closed afterwards.
+    """
+    shapes = gpd.GeoSeries(
+        [
+            box(X0 + 1, Y0 + 1, X1 - 1, Y0 / 2 + Y1 / 2),
+            box(X0 + 1, Y0 / 2 + Y1 / 2, X1 - 1, Y1 - 1),
+        ],
+        crs=ref.crs,
+    ).rename_axis("shape")
+    excluder = ExclusionContainer(ref.crs, res=0.01)
+    excluder.add_raster(raster)
+    ds = ref.availabilitymatrix(shapes, excluder)
+
+    opened = []
+
+    def rio_open(*args, **kwargs):
+        dataset = rio_open.orig(*args, **kwargs)
+        opened.append(dataset)
+        return dataset
+
+    rio_open.orig = rio.open
+    monkeypatch.setattr(rio, "open", rio_open)
+    excluder = ExclusionContainer(ref.crs, res=0.01)
+    excluder.add_raster(raster)
+    ds_threads = ref.availabilitymatrix(shapes, excluder, 2, use_threads=True)
+    assert_equal(ds, ds_threads)
+    assert excluder.all_closed
+    assert opened and all(dataset.closed for dataset in opened)
+
+
 def test_availability_matrix_rastered_repro(ref, raster_reproject):
     """
     Availability matrix with a non-zero raster must have less available area
@@ -12,7 +12,10 @@ Created on Mon May 11 11:15:41 2020.
 
 import os
 import sys
+import threading
 from datetime import date
+from time import sleep
+from types import SimpleNamespace
 
 import geopandas as gpd
 import pytest
@@ -21,14 +24,20 @@ from dateutil.relativedelta import relativedelta
 
 urllib3.disable_warnings()
 
+import dask.array
 import numpy as np
 import pandas as pd
+import rasterio as rio
+import xarray as xr
+from rasterio.transform import from_origin
 from shapely.geometry import LineString as Line
 from shapely.geometry import Point
 from xarray.testing import assert_allclose, assert_equal
 
 import atlite
 from atlite import Cutout
+from atlite.data import chunksizes
+from atlite.datasets import era5
 
 # %% Predefine tests for cutout
 
@@ -514,6 +523,48 @@ def cutout_gebco(tmp_path_factory):
     return cutout
 
 
+@pytest.fixture(scope="session")
+def gebco_path_synthetic(tmp_path_factory):
+    """
+    Synthetic GEBCO-like raster with a linear height.
+    """
+    tmp_path = tmp_path_factory.mktemp("gebco_synthetic")
+    res = 1 / 120
+    lon = np.arange(-6, 4, res) + res / 2
+    lat = np.arange(64, 54, -res) - res / 2
+    height = (100 * lon[None, :] + 10 * lat[:, None]).astype("float32")
+    path = tmp_path / "gebco.tif"
+    with rio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=len(lat),
+        width=len(lon),
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(-6, 64, res, res),
+    ) as dst:
+        dst.write(height, 1)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def cutout_gebco_synthetic(tmp_path_factory, gebco_path_synthetic):
+    tmp_path = tmp_path_factory.mktemp("gebco_synthetic")
+    cutout = Cutout(
+        path=tmp_path / "gebco",
+        module="gebco",
+        bounds=BOUNDS,
+        time=TIME,
+        dx=0.132,
+        dy=0.32,
+        gebco_path=gebco_path_synthetic,
+    )
+    cutout.prepare()
+    return cutout
+
+
 class TestERA5:
     @staticmethod
     def test_data_module_arguments_era5(cutout_era5):
@@ -767,3 +818,248 @@ class TestGebco:
         Every cells should have data.
         """
         assert np.isfinite(cutout_gebco.data).all()
+
+
+class TestGebcoSynthetic:
+    @staticmethod
+    def test_height_gebco_synthetic(cutout_gebco_synthetic):
+        """
+        The averaged height of a linear field is the height at the cell
+        center.
+        """
+        height = cutout_gebco_synthetic.data.height
+        expected = 100 * height.x + 10 * height.y
+        assert_allclose(height, expected.transpose(*height.dims), atol=1e-2)
+
+    @staticmethod
+    def test_chunksizes_gebco_synthetic(cutout_gebco_synthetic):
+        """
+        The static height has no time dimension and is stored in one chunk.
+        """
+        height = cutout_gebco_synthetic.data.height
+        assert height.encoding["chunksizes"] == height.shape
+
+    @staticmethod
+    def test_auto_chunks_gebco_synthetic(gebco_path_synthetic, tmp_path):
+        """
+        A cutout without explicit chunks must stay dask-backed after
+        preparation.
+        """
+        cutout = Cutout(
+            path=tmp_path / "gebco",
+            module="gebco",
+            bounds=BOUNDS,
+            time=TIME,
+            gebco_path=gebco_path_synthetic,
+            chunks="auto",
+        )
+        cutout.prepare()
+        assert cutout.data.height.chunks is not None
+
+
+def test_chunksizes_capped():
+    """
+    Chunks on disk follow the cutout chunks but stay below the size limit.
+    """
+    shape = (8760, 2881, 5760)
+    da = xr.DataArray(dask.array.zeros(shape, chunks=-1), dims=("time", "y", "x"))
+    assert chunksizes(da, {"time": 100}, max_bytes=2**40) == (100, 2881, 5760)
+    sizes = chunksizes(da, {"time": 100}, dtype="float32")
+    assert np.prod(sizes) * 4 <= 2**28
+    assert sizes[0] == 100
+
+
+@pytest.mark.parametrize("concurrent_requests", [1, 2])
+def test_concurrent_requests_era5(tmp_path, monkeypatch, concurrent_requests):
+    """
+    The monthly ERA5 requests of a feature are capped by `concurrent_requests`.
+    """
+    cutout = Cutout(
+        path=tmp_path / "era5",
+        module="era5",
+        bounds=BOUNDS,
+        time=slice("2013-01-01", "2013-06-30"),
+    )
+    active, peak, lock = [0], [0], threading.Lock()
+
+    def get_data_fake(retrieval_params):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        sleep(0.05)
+        with lock:
+            active[0] -= 1
+        times = cutout.coords["time"].to_index()
+        times = times[times.month == int(retrieval_params["month"])]
+        return xr.Dataset({"fake": ("time", np.zeros(len(times)))}, {"time": times})
+
+    monkeypatch.setattr(era5, "get_data_fake", get_data_fake, raising=False)
+    ds = era5.get_data(
+        cutout, "fake", tmp_path, concurrent_requests=concurrent_requests
+    )
+    assert peak[0] == concurrent_requests
+    assert ds.sizes["time"] == cutout.data.sizes["time"]
+
+
+@pytest.fixture
+def fake_module(monkeypatch):
+    """
+    Offline data module with two features, each providing one variable.
+    """
+
+    def get_data(cutout, feature, tmpdir, **creation_parameters):
+        var = {"foo": "a", "bar": "b"}[feature]
+        shape = tuple(cutout.data.sizes[d] for d in ("time", "y", "x"))
+        da = xr.DataArray(np.ones(shape), dims=("time", "y", "x"), name=var)
+        return da.to_dataset().assign_coords(cutout.coords)
+
+    module = SimpleNamespace(
+        crs=4326, features={"foo": ["a"], "bar": ["b"]}, get_data=get_data
+    )
+    monkeypatch.setitem(atlite.datasets.modules, "fake", module)
+    return module
+
+
+@pytest.mark.parametrize("write_once", [False, True])
+@pytest.mark.parametrize("dask_kwargs", [None, {"scheduler": "synchronous"}])
+def test_prepare_modules_writes(
+    tmp_path, monkeypatch, fake_module, gebco_path_synthetic, dask_kwargs, write_once
+):
+    """
+    The cutout is written per module, or once for all modules if requested.
+    """
+    cutout = Cutout(
+        path=tmp_path / "cutout",
+        module=["gebco", "fake"],
+        bounds=BOUNDS,
+        time=TIME,
+        gebco_path=gebco_path_synthetic,
+    )
+    replace = os.replace
+    writes = []
+
+    def replace_counted(src, dst):
+        writes.append(dst)
+        return replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", replace_counted)
+    cutout.prepare(dask_kwargs=dask_kwargs, write_once=write_once)
+
+    assert writes == [cutout.path] * (1 if write_once else 2)
+    assert set(cutout.data) == {"height", "a", "b"}
+    prepared_features_test(cutout)
+    assert cutout.data.b.attrs["module"] == "fake"
+    assert cutout.data.b.attrs["feature"] == "bar"
+    with xr.open_dataset(cutout.path) as ds:
+        assert set(np.atleast_1d(ds.attrs["prepared_features"])) == {
+            "height",
+            "foo",
+            "bar",
+        }
+
+
+def test_prepare_modules_checkpoint(
+    tmp_path, monkeypatch, fake_module, gebco_path_synthetic
+):
+    """
+    The features of completed modules are kept if a later module fails.
+    """
+    cutout = Cutout(
+        path=tmp_path / "cutout",
+        module=["gebco", "fake"],
+        bounds=BOUNDS,
+        time=TIME,
+        gebco_path=gebco_path_synthetic,
+    )
+
+    def get_data_failing(cutout, feature, tmpdir, **creation_parameters):
+        raise RuntimeError("request failed")
+
+    monkeypatch.setattr(fake_module, "get_data", get_data_failing)
+    with pytest.raises(RuntimeError):
+        cutout.prepare()
+
+    cutout = Cutout(path=tmp_path / "cutout")
+    assert set(cutout.data) == {"height"}
+    prepared_features_test(cutout)
+
+
+def test_prepare_dask_kwargs_processes(cutout_gebco_synthetic, tmp_path):
+    """
+    The scheduler in `dask_kwargs` is used for the retrieval and the write.
+    """
+    cutout = Cutout(
+        path=tmp_path / "gebco",
+        module="gebco",
+        bounds=BOUNDS,
+        time=TIME,
+        dx=0.132,
+        dy=0.32,
+        gebco_path=cutout_gebco_synthetic.data.attrs["gebco_path"],
+    )
+    cutout.prepare(dask_kwargs={"scheduler": "processes", "num_workers": 2})
+    assert_equal(cutout.data.height, cutout_gebco_synthetic.data.height)
+
+
+def test_chunksizes_concatenated_files(tmp_path, monkeypatch):
+    """
+    Variables concatenated from monthly files and renamed, as in the ERA5
+    module, are stored in chunks aligned with the cutout chunks.
+    """
+
+    def get_data(cutout, feature, tmpdir, **creation_parameters):
+        datasets = []
+        for month, ds in cutout.data.groupby("time.month"):
+            shape = tuple(ds.sizes[d] for d in ("time", "y", "x"))
+            t2m = xr.DataArray(np.ones(shape), dims=("time", "y", "x"))
+            path = os.path.join(tmpdir, f"{month}.nc")
+            t2m.to_dataset(name="t2m").assign_coords(ds.coords).to_netcdf(path)
+            datasets.append(xr.open_dataset(path, chunks={}))
+        ds = xr.concat(datasets, dim="time").rename(t2m="temperature")
+        return ds.assign_coords(cutout.coords)
+
+    module = SimpleNamespace(
+        crs=4326, features={"temperature": ["temperature"]}, get_data=get_data
+    )
+    monkeypatch.setitem(atlite.datasets.modules, "fake", module)
+    cutout = Cutout(
+        path=tmp_path / "cutout",
+        module="fake",
+        bounds=BOUNDS,
+        time=slice("2013-01-28", "2013-02-04"),
+    )
+    cutout.prepare()
+
+    temperature = cutout.data.temperature
+    expected = (100, temperature.sizes["y"], temperature.sizes["x"])
+    assert temperature.encoding["chunksizes"] == expected
+
+
+def test_fill_value_masked_integers(tmp_path, monkeypatch):
+    """
+    NaNs of variables stored as masked integers are kept in the cutout.
+    """
+
+    def get_data(cutout, feature, tmpdir, **creation_parameters):
+        shape = tuple(cutout.data.sizes[d] for d in ("time", "y", "x"))
+        values = np.ones(shape)
+        values[0] = np.nan
+        ds = xr.DataArray(values, dims=("time", "y", "x")).to_dataset(name="sp")
+        path = os.path.join(tmpdir, "sp.nc")
+        ds.assign_coords(cutout.coords).to_netcdf(
+            path, encoding={"sp": {"dtype": "int16", "_FillValue": -999}}
+        )
+        ds = xr.open_dataset(path).rename(sp="pressure")
+        return ds.assign_coords(cutout.coords)
+
+    module = SimpleNamespace(
+        crs=4326, features={"pressure": ["pressure"]}, get_data=get_data
+    )
+    monkeypatch.setitem(atlite.datasets.modules, "fake", module)
+    cutout = Cutout(path=tmp_path / "cutout", module="fake", bounds=BOUNDS, time=TIME)
+    cutout.prepare()
+
+    pressure = cutout.data.pressure
+    assert pressure.encoding["dtype"] == "int16"
+    assert pressure.isel(time=0).isnull().all()
+    assert (pressure.isel(time=slice(1, None)) == 1).all()